@@ -1,7 +1,10 @@
 import io
-import base64
+import os
+import threading
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
+
+from workers import MicroBatcher, read_capped, run_blocking, pooled_bytesio, written_view
 
 try:
     import cv2
@@ -9,9 +12,212 @@ except ImportError:
     cv2 = None
 
 try:
-    from rembg import remove
+    from rembg import remove, new_session
+    import onnxruntime as ort
 except ImportError:
     remove = None
+    new_session = None
+    ort = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Global variables
+# u2netp is the ~5MB U2-Net variant; REMBG_MODEL_PATH points at a custom U2-Net
+# ONNX file (e.g. an INT8 quantize_dynamic export) and takes precedence
+REMBG_MODEL = os.getenv("REMBG_MODEL", "u2netp")
+REMBG_MODEL_PATH = os.getenv("REMBG_MODEL_PATH")
+_REMBG_SESSION = None
+_REMBG_SESSION_LOCK = threading.Lock()
+
+def get_rembg_session():
+    """Return the shared rembg session, creating it on first use"""
+    global _REMBG_SESSION
+    if _REMBG_SESSION is None:
+        with _REMBG_SESSION_LOCK:
+            if _REMBG_SESSION is None:
+                available = ort.get_available_providers()
+                providers = [p for p in ("CUDAExecutionProvider", "CPUExecutionProvider") if p in available]
+                if REMBG_MODEL_PATH:
+                    _REMBG_SESSION = new_session("u2net_custom", model_path=REMBG_MODEL_PATH, providers=providers)
+                else:
+                    _REMBG_SESSION = new_session(REMBG_MODEL, providers=providers)
+                print(f"✅ rembg session created ({REMBG_MODEL_PATH or REMBG_MODEL}, {', '.join(providers)})")
+    return _REMBG_SESSION
+
+# U2-Net pre-processing, shared by the batched mask inference
+U2NET_MEAN = (0.485, 0.456, 0.406)
+U2NET_STD = (0.229, 0.224, 0.225)
+U2NET_SIZE = (320, 320)
+
+class _PrecomputedMaskSession:
+    """Stand-in rembg session that returns masks computed by the batcher"""
+
+    def __init__(self, masks):
+        self.masks = masks
+
+    def predict(self, img, *args, **kwargs):
+        return self.masks
+
+class BackgroundRemovalBatcher(MicroBatcher):
+    """Gather concurrent mask predictions and run them as one ORT batch"""
+
+    def _predict_batch(self, images):
+        session = get_rembg_session()
+        
+        # Only the U2-Net family shares this pre/post-processing
+        if type(session).__name__ not in ("U2netSession", "U2netpSession", "U2netCustomSession"):
+            return [session.predict(img) for img in images]
+        
+        model_input = session.inner_session.get_inputs()[0]
+        tensors = [
+            session.normalize(img, U2NET_MEAN, U2NET_STD, U2NET_SIZE)[model_input.name]
+            for img in images
+        ]
+        
+        if isinstance(model_input.shape[0], int):
+            # Model was exported with a fixed batch size, run one at a time
+            preds = np.concatenate([
+                session.inner_session.run(None, {model_input.name: t})[0] for t in tensors
+            ])
+        else:
+            preds = session.inner_session.run(None, {model_input.name: np.concatenate(tensors)})[0]
+        
+        # Same per-image normalization as rembg's U2netSession.predict
+        results = []
+        for img, pred in zip(images, preds[:, 0, :, :]):
+            mi, ma = np.min(pred), np.max(pred)
+            pred = (pred - mi) / (ma - mi)
+            mask = Image.fromarray((pred * 255).astype("uint8"), mode="L")
+            results.append([mask.resize(img.size, Image.Resampling.LANCZOS)])
+        return results
+
+_BATCHER = BackgroundRemovalBatcher()
+
+def warm_rembg():
+    """Create the rembg session and run one tiny batch so ORT is initialized before the first request
+
+    Also compiles the Numba compositing kernel (or loads it from the cache) here
+    rather than on the first /custom-background request.
+    """
+    if remove is None:
+        print("❌ rembg not available - background features disabled")
+        return False
+    try:
+        _BATCHER._predict_batch([Image.new("RGB", (32, 32))])
+        composite_over_solid(np.zeros((2, 2, 4), dtype=np.uint8), 255, 255, 255)
+        return True
+    except Exception as e:
+        print(f"❌ rembg warm-up failed: {str(e)}")
+        return False
+
+async def remove_batched(img, **kwargs):
+    """rembg.remove() with the mask inference coalesced through the batcher"""
+    # rembg applies EXIF orientation before predicting; do it first so mask sizes match
+    # (reading the tag is header-only, the transpose decodes the whole image)
+    if img.getexif().get(0x0112, 1) != 1:
+        img = await run_blocking(ImageOps.exif_transpose, img)
+    masks = await _BATCHER.predict(img)
+    return await run_blocking(remove, img, session=_PrecomputedMaskSession(masks), **kwargs)
+
+def open_image(contents, mode=None):
+    """Decode uploaded bytes with PIL, optionally converting to mode"""
+    image = Image.open(io.BytesIO(contents))
+    return image.convert(mode) if mode else image
+
+def rgba_array(image):
+    """PIL image as an RGBA array, converting only if it is not RGBA already (copies; call off the event loop)"""
+    return np.asarray(image if image.mode == 'RGBA' else image.convert('RGBA'))
+
+def encode_png(image):
+    """Encode a PIL image as PNG (fast DEFLATE level)"""
+    with pooled_bytesio() as img_buffer:
+        image.save(img_buffer, format='PNG', compress_level=1)
+        # Copy out before the buffer goes back to the pool
+        with written_view(img_buffer) as data:
+            return bytes(data)
+
+def encode_jpeg(image_bgr):
+    """Encode a BGR array as JPEG"""
+    _, buffer = cv2.imencode('.jpg', image_bgr, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buffer
+
+def decode_for_blur(contents):
+    """Decode upload bytes to (BGR array, RGB PIL image for rembg), or None"""
+    # imdecode also applies EXIF orientation
+    original_cv = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+    if original_cv is None:
+        return None
+    return original_cv, Image.fromarray(cv2.cvtColor(original_cv, cv2.COLOR_BGR2RGB))
+
+def blur_with_mask(original_cv, mask_image):
+    """Blur original_cv everywhere rembg's mask (a PIL 'L' image) is not foreground"""
+    mask_cv = np.asarray(mask_image)
+    # Stays in BGR since blur/blend ignore channel order
+    # (stackBlur is much faster than GaussianBlur for large kernels, OpenCV 4.7+)
+    if hasattr(cv2, "stackBlur"):
+        blurred = cv2.stackBlur(original_cv, (51, 51))
+    else:
+        blurred = cv2.GaussianBlur(original_cv, (51, 51), 0)
+    
+    # Normalize mask to 0-1 range in place (kept single-channel, blendLinear needs no 3-channel copy)
+    mask_normalized = mask_cv.astype(np.float32)
+    mask_normalized *= 1 / 255.0
+    
+    # Blend original and blurred using mask in a single uint8 pass
+    return cv2.blendLinear(original_cv, blurred, mask_normalized, 1.0 - mask_normalized)
+
+def replace_with_background(cutout, bg_image):
+    """Resize bg_image to the cutout's size and composite the cutout over it"""
+    fg = rgba_array(cutout)
+    # INTER_AREA when shrinking, it is both faster and sharper than LANCZOS there
+    h, w = fg.shape[:2]
+    shrinking = bg_image.shape[0] * bg_image.shape[1] > h * w
+    interpolation = cv2.INTER_AREA if shrinking else cv2.INTER_CUBIC
+    bg_resized = cv2.resize(bg_image, (w, h), interpolation=interpolation)
+    return composite_over_background(fg, bg_resized)
+
+def _composite_over_solid_numpy(fg, r, g, b):
+    """NumPy fallback for composite_over_solid"""
+    alpha = fg[:, :, 3:4] * np.float32(1 / 255.0)
+    bg = np.array([r, g, b], dtype=np.float32)
+    return (fg[:, :, :3] * alpha + bg * (1 - alpha) + 0.5).astype(np.uint8)
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def composite_over_solid(fg, r, g, b):
+        """Composite an RGBA uint8 array over an opaque (r, g, b) colour"""
+        h, w = fg.shape[0], fg.shape[1]
+        out = np.empty((h, w, 3), dtype=np.uint8)
+        bg = (r, g, b)
+        for y in prange(h):
+            for x in range(w):
+                a = fg[y, x, 3] * (1.0 / 255.0)
+                for c in range(3):
+                    out[y, x, c] = np.uint8(fg[y, x, c] * a + bg[c] * (1.0 - a) + 0.5)
+        return out
+else:
+    composite_over_solid = _composite_over_solid_numpy
+
+def solid_background(cutout, r, g, b):
+    """Composite rembg's cutout over an opaque (r, g, b) colour, as an RGB PIL image"""
+    return Image.fromarray(composite_over_solid(rgba_array(cutout), r, g, b), 'RGB')
+
+def composite_over_background(fg, bg):
+    """Composite an RGBA uint8 array onto a same-sized BGR background, in place"""
+    alpha = fg[:, :, 3]
+    # Outside the subject's bounding box the result is just the background
+    x, y, w, h = cv2.boundingRect(alpha)
+    if w == 0 or h == 0:
+        return bg
+    
+    a = alpha[y:y + h, x:x + w, None] * np.float32(1 / 255.0)
+    fg_bgr = fg[y:y + h, x:x + w, 2::-1]
+    bg_roi = bg[y:y + h, x:x + w]
+    bg_roi[:] = (fg_bgr * a + bg_roi * (1 - a) + 0.5).astype(np.uint8)
+    return bg
 
 async def remove_background(file):
     """Remove background from uploaded image using rembg"""
@@ -20,20 +226,21 @@ async def remove_background(file):
             return {"error": "rembg library not available", "status_code": 500}
         
         # Read and process the uploaded image
-        contents = await file.read()
-        input_image = Image.open(io.BytesIO(contents))
+        contents = await read_capped(file)
+        if contents is None:
+            return {"error": "Image file too large (max 5MB)", "status_code": 413}
+        input_image = await run_blocking(open_image, contents)
         
         # Remove the background using rembg
-        output_image = remove(input_image)
+        output_image = await remove_batched(input_image)
         
-        # Convert result to base64
-        img_buffer = io.BytesIO()
-        output_image.save(img_buffer, format='PNG')
-        img_str = base64.b64encode(img_buffer.getvalue()).decode()
+        # Encode result (PNG needed for alpha)
+        image_bytes = await run_blocking(encode_png, output_image)
         
         return {
             "success": True,
-            "image": f"data:image/png;base64,{img_str}",
+            "image_bytes": image_bytes,
+            "media_type": "image/png",
             "message": "Background removed successfully"
         }
         
@@ -50,38 +257,28 @@ async def blur_background(file):
             return {"error": "OpenCV not available", "status_code": 500}
         
         # Read and process the uploaded image
-        contents = await file.read()
-        input_image = Image.open(io.BytesIO(contents)).convert('RGB')
+        contents = await read_capped(file)
+        if contents is None:
+            return {"error": "Image file too large (max 5MB)", "status_code": 413}
+        # Decode straight to a BGR array, plus the RGB copy rembg needs
+        decoded = await run_blocking(decode_for_blur, contents)
+        if decoded is None:
+            return {"error": "Invalid image format", "status_code": 400}
+        original_cv, input_image = decoded
         
         # Get the mask using rembg
-        mask_image = remove(input_image, only_mask=True)
+        mask_image = await remove_batched(input_image, only_mask=True)
         
-        # Convert PIL images to OpenCV format
-        original_cv = cv2.cvtColor(np.array(input_image), cv2.COLOR_RGB2BGR)
-        mask_cv = np.array(mask_image)
+        # Blur the background
+        result = await run_blocking(blur_with_mask, original_cv, mask_image)
         
-        # Create blurred version of original image
-        blurred = cv2.GaussianBlur(original_cv, (51, 51), 0)
-        
-        # Normalize mask to 0-1 range
-        mask_normalized = mask_cv.astype(np.float32) / 255.0
-        mask_3channel = np.stack([mask_normalized] * 3, axis=-1)
-        
-        # Blend original and blurred using mask
-        result = original_cv.astype(np.float32) * mask_3channel + blurred.astype(np.float32) * (1 - mask_3channel)
-        result = result.astype(np.uint8)
-        
-        # Convert back to PIL and then to base64
-        result_rgb = cv2.cvtColor(result, cv2.COLOR_BGR2RGB)
-        result_pil = Image.fromarray(result_rgb)
-        
-        img_buffer = io.BytesIO()
-        result_pil.save(img_buffer, format='PNG')
-        img_str = base64.b64encode(img_buffer.getvalue()).decode()
+        # Encode as JPEG (photographic output, no alpha)
+        image_bytes = await run_blocking(encode_jpeg, result)
         
         return {
             "success": True,
-            "image": f"data:image/png;base64,{img_str}",
+            "image_bytes": image_bytes,
+            "media_type": "image/jpeg",
             "message": "Background blurred successfully"
         }
         
@@ -98,11 +295,13 @@ async def custom_background_color(file, color="#FFFFFF"):
         print(f"Received color: {color}")
         
         # Read and process the uploaded image
-        contents = await file.read()
-        input_image = Image.open(io.BytesIO(contents)).convert('RGBA')
+        contents = await read_capped(file)
+        if contents is None:
+            return {"error": "Image file too large (max 5MB)", "status_code": 413}
+        input_image = await run_blocking(open_image, contents)
         
         # Remove the background using rembg
-        output_image = remove(input_image)
+        output_image = await remove_batched(input_image)
         
         # Parse hex color
         color_clean = color.lstrip('#')
@@ -114,19 +313,16 @@ async def custom_background_color(file, color="#FFFFFF"):
         except ValueError:
             return {"error": "Invalid hex color", "status_code": 400}
         
-        # Create new image with custom background
-        background = Image.new('RGBA', output_image.size, (r, g, b, 255))
-        result = Image.alpha_composite(background, output_image)
-        result = result.convert('RGB')
+        # Composite straight onto the colour, no background image needed
+        result = await run_blocking(solid_background, output_image, r, g, b)
         
-        # Convert result to base64
-        img_buffer = io.BytesIO()
-        result.save(img_buffer, format='PNG')
-        img_str = base64.b64encode(img_buffer.getvalue()).decode()
+        # Encode result
+        image_bytes = await run_blocking(encode_png, result)
         
         return {
             "success": True,
-            "image": f"data:image/png;base64,{img_str}",
+            "image_bytes": image_bytes,
+            "media_type": "image/png",
             "message": f"Background replaced with color {color}"
         }
         
@@ -139,34 +335,36 @@ async def custom_background_image(file, background_file):
     try:
         if remove is None:
             return {"error": "rembg library not available", "status_code": 500}
+        if cv2 is None:
+            return {"error": "OpenCV not available", "status_code": 500}
         
         # Read and process the main image
-        contents = await file.read()
-        input_image = Image.open(io.BytesIO(contents)).convert('RGBA')
-        
-        # Read and process the background image
-        bg_contents = await background_file.read()
-        bg_image = Image.open(io.BytesIO(bg_contents)).convert('RGB')
+        contents = await read_capped(file)
+        if contents is None:
+            return {"error": "Image file too large (max 5MB)", "status_code": 413}
+        input_image = await run_blocking(open_image, contents)
+        
+        # Read and decode the background image (BGR)
+        bg_contents = await read_capped(background_file)
+        if bg_contents is None:
+            return {"error": "Background image too large (max 5MB)", "status_code": 413}
+        bg_image = await run_blocking(cv2.imdecode, np.frombuffer(bg_contents, np.uint8), cv2.IMREAD_COLOR)
+        if bg_image is None:
+            return {"error": "Invalid background image format", "status_code": 400}
         
         # Remove the background from main image
-        output_image = remove(input_image)
-        
-        # Resize background to match main image size
-        bg_resized = bg_image.resize(output_image.size, Image.Resampling.LANCZOS)
-        bg_rgba = bg_resized.convert('RGBA')
+        output_image = await remove_batched(input_image)
         
-        # Composite the images
-        result = Image.alpha_composite(bg_rgba, output_image)
-        result = result.convert('RGB')
+        # Resize background to match main image size and composite
+        result = await run_blocking(replace_with_background, output_image, bg_image)
         
-        # Convert result to base64
-        img_buffer = io.BytesIO()
-        result.save(img_buffer, format='PNG')
-        img_str = base64.b64encode(img_buffer.getvalue()).decode()
+        # Encode as JPEG (photographic output, no alpha)
+        image_bytes = await run_blocking(encode_jpeg, result)
         
         return {
             "success": True,
-            "image": f"data:image/png;base64,{img_str}",
+            "image_bytes": image_bytes,
+            "media_type": "image/jpeg",
             "message": "Background replaced with custom image"
         }
         
@@ -1,13 +1,15 @@
-import io
 import numpy as np
-from PIL import Image
 import pickle
-import os
+
+from workers import CPU_THREADS, MODEL_DIR, MicroBatcher, read_capped, run_blocking
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
 
 try:
     from tensorflow.keras.models import load_model
-    from tensorflow.keras.preprocessing.image import img_to_array
-    from tensorflow.keras.applications.vgg16 import preprocess_input
     from tensorflow.keras.applications import VGG16
     import tensorflow as tf
 except ImportError:
@@ -15,23 +17,204 @@ except ImportError:
     VGG16 = None
     tf = None
 
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+try:
+    import tf2onnx
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+except ImportError:
+    tf2onnx = None
+
+CAPTION_MODEL_PATH = MODEL_DIR / "model.h5"
+TOKENIZER_PATH = MODEL_DIR / "tokenizer.pkl"
+VGG16_ONNX_PATH = MODEL_DIR / "vgg16_fc2.onnx"
+VGG16_ONNX_INT8_PATH = MODEL_DIR / "vgg16_fc2.int8.onnx"
+VGG16_KERAS_PATH = MODEL_DIR / "vgg16_fc2.keras"
+CAPTION_ONNX_PATH = MODEL_DIR / "model.onnx"
+ONNX_OPSET = 17
+ONNX_DTYPES = {"tensor(float)": np.float32, "tensor(int32)": np.int32, "tensor(int64)": np.int64}
+
+# VGG16 "caffe" preprocessing: BGR channel order with ImageNet mean subtracted
+VGG16_MEAN_BGR = np.array([103.939, 116.779, 123.68], dtype=np.float32)
+
+# Files don't appear at runtime, so /model-status needn't stat them on every poll
+_MODEL_EXISTS = {
+    "caption_model": CAPTION_MODEL_PATH.exists(),
+    "tokenizer": TOKENIZER_PATH.exists(),
+}
+
 # Global variables
 caption_model = None
 tokenizer = None
 feature_extractor = None
+caption_step = None
+caption_seq_len = None
+index_word = {}
+
+def build_caption_step(model):
+    """Build the per-token decoding step, returning (step, fixed sequence length or None)
+
+    The step takes the left-aligned token buffer plus the number of valid tokens
+    and returns the predicted next token id.
+    """
+    seq_len = model.inputs[1].shape[1]
+    
+    if seq_len is None:
+        # Variable-length input: feed only the valid prefix, no XLA (shape changes each step)
+        @tf.function(input_signature=[
+            tf.TensorSpec(shape=(1, 4096), dtype=tf.float32),
+            tf.TensorSpec(shape=(1, None), dtype=tf.int32),
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+        ])
+        def step(image_features, sequence, length):
+            prediction = model([image_features, sequence[:, :length]], training=False)
+            return tf.argmax(tf.reshape(prediction, (1, -1)), axis=-1, output_type=tf.int32)
+        return step, None
+    
+    # Fixed-length input: one concrete shape, so XLA can compile the whole step once
+    @tf.function(jit_compile=True, input_signature=[
+        tf.TensorSpec(shape=(1, 4096), dtype=tf.float32),
+        tf.TensorSpec(shape=(1, seq_len), dtype=tf.int32),
+        tf.TensorSpec(shape=(), dtype=tf.int32),
+    ])
+    def step(image_features, sequence, length):
+        # Shift the valid tokens to the end, zeros in front (pad_sequences' default "pre" padding)
+        idx = tf.range(seq_len) - (seq_len - length)
+        padded = tf.where(idx >= 0, tf.gather(sequence[0], tf.maximum(idx, 0)), 0)
+        prediction = model([image_features, padded[None]], training=False)
+        return tf.argmax(tf.reshape(prediction, (1, -1)), axis=-1, output_type=tf.int32)
+    return step, seq_len
+
+def build_ort_caption_step(session):
+    """ONNX Runtime version of build_caption_step, with the same step signature"""
+    image_input, text_input = session.get_inputs()[:2]
+    seq_len = text_input.shape[1] if isinstance(text_input.shape[1], int) else None
+    text_dtype = ONNX_DTYPES.get(text_input.type, np.float32)
+    
+    def step(image_features, sequence, length):
+        if seq_len is None:
+            tokens = sequence[:, :length].astype(text_dtype)
+        else:
+            # Same "pre" padding as the XLA step: valid tokens at the end
+            tokens = np.zeros((1, seq_len), dtype=text_dtype)
+            tokens[0, seq_len - length:] = sequence[0, :length]
+        prediction = session.run(None, {
+            image_input.name: np.asarray(image_features, dtype=np.float32),
+            text_input.name: tokens,
+        })[0]
+        return np.argmax(prediction.reshape(1, -1), axis=-1)
+    return step, seq_len
+
+def create_ort_session(path):
+    """CPU ONNX Runtime session with full graph optimization"""
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.intra_op_num_threads = CPU_THREADS
+    return ort.InferenceSession(str(path), sess_options=sess_options, providers=["CPUExecutionProvider"])
+
+def export_caption_onnx():
+    """One-time export of the caption model to ONNX, next to the .h5"""
+    if tf2onnx is None or load_model is None:
+        return False
+    try:
+        model = load_model(str(CAPTION_MODEL_PATH), compile=False)
+        tf2onnx.convert.from_keras(model, opset=ONNX_OPSET, output_path=str(CAPTION_ONNX_PATH))
+        print(f"Caption model exported to {CAPTION_ONNX_PATH}")
+        return True
+    except Exception as e:
+        print(f"Failed to export caption model to ONNX: {e}")
+        return False
+
+def build_vgg16_fc2():
+    """Build the Keras VGG16 model truncated at fc2"""
+    vgg_model = VGG16(weights='imagenet', include_top=True)
+    return tf.keras.Model(inputs=vgg_model.input, outputs=vgg_model.get_layer('fc2').output)
+
+def export_vgg16_onnx():
+    """One-time export of the fc2 extractor to ONNX plus an int8 quantized copy"""
+    if tf2onnx is None:
+        return False
+    try:
+        model = build_vgg16_fc2()
+        spec = (tf.TensorSpec((None, 224, 224, 3), tf.float32, name="input"),)
+        tf2onnx.convert.from_keras(model, input_signature=spec, opset=ONNX_OPSET, output_path=str(VGG16_ONNX_PATH))
+        # fc1/fc2 weights dominate the model size, dynamic int8 quantization shrinks them 4x
+        quantize_dynamic(str(VGG16_ONNX_PATH), str(VGG16_ONNX_INT8_PATH), weight_type=QuantType.QInt8)
+        print(f"VGG16 feature extractor exported to {VGG16_ONNX_INT8_PATH}")
+        return True
+    except Exception as e:
+        print(f"Failed to export VGG16 to ONNX: {e}")
+        return False
+
+def load_vgg16_fc2():
+    """Load the trimmed fc2 extractor, saving it on first build
+
+    Later loads skip constructing the full VGG16 and never hold the unused
+    1000-class predictions layer.
+    """
+    if VGG16_KERAS_PATH.exists():
+        return load_model(str(VGG16_KERAS_PATH), compile=False)
+    model = build_vgg16_fc2()
+    try:
+        model.save(str(VGG16_KERAS_PATH))
+    except Exception as e:
+        print(f"Failed to cache trimmed VGG16: {e}")
+    return model
+
+def build_vgg16_fn(model):
+    """Wrap the Keras extractor in a compiled forward pass, avoiding .predict() per-call overhead"""
+    @tf.function(jit_compile=True, input_signature=[
+        tf.TensorSpec(shape=(None, 224, 224, 3), dtype=tf.float32),
+    ])
+    def forward(images):
+        return model(images, training=False)
+    return forward
+
+def load_feature_extractor():
+    """Load VGG16 fc2 extractor, preferring the ONNX Runtime export over Keras"""
+    if ort is not None:
+        if not VGG16_ONNX_INT8_PATH.exists() and not VGG16_ONNX_PATH.exists():
+            export_vgg16_onnx()
+        for path in (VGG16_ONNX_INT8_PATH, VGG16_ONNX_PATH):
+            if path.exists():
+                return create_ort_session(path)
+    return build_vgg16_fn(load_vgg16_fc2())
+
+def load_caption_step():
+    """Build the decoding step, preferring an ONNX Runtime export of the caption model"""
+    global caption_model
+    if ort is not None:
+        if not CAPTION_ONNX_PATH.exists():
+            export_caption_onnx()
+        if CAPTION_ONNX_PATH.exists():
+            caption_model = create_ort_session(CAPTION_ONNX_PATH)
+            return build_ort_caption_step(caption_model)
+    caption_model = load_model(str(CAPTION_MODEL_PATH), compile=False)
+    return build_caption_step(caption_model)
 
 def load_caption_model():
     """Load caption model and tokenizer"""
-    global caption_model, tokenizer, feature_extractor
+    global tokenizer, feature_extractor, caption_step, caption_seq_len, index_word
     try:
         if load_model is not None and VGG16 is not None:
-            caption_model = load_model("C:\\Users\\nilab\\OneDrive\\Desktop\\Project25\\Image-EDit\\Creaza-Main-1-main2\\ai-service\\Models\\model.h5")
-            with open("C:\\Users\\nilab\\OneDrive\\Desktop\\Project25\\Image-EDit\\Creaza-Main-1-main2\\ai-service\\Models\\tokenizer.pkl", 'rb') as f:
+            # XLA auto-clustering for any TF graph not already compiled explicitly
+            tf.config.optimizer.set_jit(True)
+            
+            with open(TOKENIZER_PATH, 'rb') as f:
                 tokenizer = pickle.load(f)
+            index_word = dict(tokenizer.index_word)
+            caption_step, caption_seq_len = load_caption_step()
             
-            # Load VGG16 feature extractor
-            vgg_model = VGG16(weights='imagenet', include_top=True)
-            feature_extractor = tf.keras.Model(inputs=vgg_model.input, outputs=vgg_model.get_layer('fc2').output)
+            # Trace/compile the decoding step now rather than on the first request
+            warmup_sequence = create_initial_sequence(caption_seq_len or 1)
+            caption_step(np.zeros((1, 4096), dtype=np.float32), warmup_sequence, 1)
+            
+            # Load VGG16 feature extractor and run it once so the first request skips tracing/compiling
+            feature_extractor = load_feature_extractor()
+            extract_features(np.zeros((1, 224, 224, 3), dtype=np.float32), feature_extractor)
             
             print("Caption model, tokenizer, and feature extractor loaded successfully")
         else:
@@ -40,48 +223,71 @@ def load_caption_model():
         print(f"Failed to load caption model: {e}")
 
 def preprocess_image_for_caption(img):
-    """Preprocess image for caption model"""
+    """Preprocess a BGR image (as decoded by OpenCV) for caption model"""
     try:
-        img = img.resize((224, 224))
-        img_array = np.array(img)
-        img_array = np.expand_dims(img_array, axis=0)
-        img_array = preprocess_input(img_array)
-        return img_array
+        img = cv2.resize(img, (224, 224), interpolation=cv2.INTER_AREA)
+        img_array = img.astype(np.float32)
+        img_array -= VGG16_MEAN_BGR
+        return img_array[None]
     except Exception as e:
         print(f"Error preprocessing image: {str(e)}")
         return None
 
 def extract_features(img_array, feature_extractor):
-    """Extract features using VGG16"""
+    """Extract features using VGG16 for a (N, 224, 224, 3) batch"""
     try:
-        features = feature_extractor.predict(img_array)
-        return features
+        if ort is not None and isinstance(feature_extractor, ort.InferenceSession):
+            input_name = feature_extractor.get_inputs()[0].name
+            return feature_extractor.run(None, {input_name: img_array.astype(np.float32)})[0]
+        return feature_extractor(tf.constant(img_array, dtype=tf.float32)).numpy()
     except Exception as e:
         print(f"Error extracting features: {str(e)}")
         return None
 
-def create_initial_sequence():
-    """Create initial sequence with start token"""
-    return np.array([[1]])
+class FeatureBatcher(MicroBatcher):
+    """Run VGG16 over concurrent caption requests as one batch"""
+
+    def _predict_batch(self, images):
+        features = extract_features(np.concatenate(images), feature_extractor)
+        if features is None:
+            raise Exception("Failed to extract image features")
+        return [features[i:i + 1] for i in range(len(images))]
+
+_FEATURE_BATCHER = FeatureBatcher()
+
+def decode_for_caption(image_data):
+    """Decode uploaded bytes straight to BGR (what VGG16 expects) and preprocess"""
+    image_bgr = cv2.imdecode(np.frombuffer(image_data, np.uint8), cv2.IMREAD_COLOR)
+    if image_bgr is None:
+        return None
+    return preprocess_image_for_caption(image_bgr)
+
+def create_initial_sequence(length):
+    """Create a token buffer of the given length, holding only the start token"""
+    sequence = np.zeros((1, length), dtype=np.int32)
+    sequence[0, 0] = 1
+    return sequence
 
 def generate_caption(image_features, max_length=20):
     """Generate caption from image features"""
     try:
-        sequence = create_initial_sequence()
+        features = np.asarray(image_features, dtype=np.float32)
+        if caption_seq_len is not None:
+            max_length = min(max_length, caption_seq_len - 1)
+        sequence = create_initial_sequence(caption_seq_len or max_length + 1)
         caption = []
         
-        for _ in range(max_length):
-            prediction = caption_model.predict([image_features, sequence])
-            predicted_id = np.argmax(prediction[0]) if len(prediction.shape) == 2 else np.argmax(prediction)
+        for pos in range(max_length):
+            predicted_id = int(caption_step(features, sequence, pos + 1)[0])
             
             # Get the word from tokenizer
-            word = tokenizer.index_word.get(predicted_id, '<unk>')
+            word = index_word.get(predicted_id, '<unk>')
             
             if word == "endseq":
                 break  # Stop generation when "endseq" is predicted
             
             caption.append(word)
-            sequence = np.append(sequence, [[predicted_id]], axis=1)
+            sequence[0, pos + 1] = predicted_id
         
         # Clean up caption
         final_caption = " ".join(caption).replace("startseq", "").strip().title()
@@ -96,13 +302,13 @@ def get_caption_status():
     return {
         "caption_model": {
             "loaded": caption_model is not None,
-            "path": "C:\\Users\\nilab\\OneDrive\\Desktop\\Project25\\Image-EDit\\Creaza-Main-1-main2\\ai-service\\Models\\model.h5",
-            "exists": os.path.exists("C:\\Users\\nilab\\OneDrive\\Desktop\\Project25\\Image-EDit\\Creaza-Main-1-main2\\ai-service\\Models\\model.h5")
+            "path": str(CAPTION_MODEL_PATH),
+            "exists": _MODEL_EXISTS["caption_model"]
         },
         "tokenizer": {
             "loaded": tokenizer is not None,
-            "path": "C:\\Users\\nilab\\OneDrive\\Desktop\\Project25\\Image-EDit\\Creaza-Main-1-main2\\ai-service\\Models\\tokenizer.pkl",
-            "exists": os.path.exists("C:\\Users\\nilab\\OneDrive\\Desktop\\Project25\\Image-EDit\\Creaza-Main-1-main2\\ai-service\\Models\\tokenizer.pkl")
+            "path": str(TOKENIZER_PATH),
+            "exists": _MODEL_EXISTS["tokenizer"]
         },
         "feature_extractor": {
             "loaded": feature_extractor is not None
@@ -113,24 +319,26 @@ async def process_caption_request(file):
     """Process caption generation request"""
     if caption_model is None or feature_extractor is None or tokenizer is None:
         return {"error": "Caption model not available", "status_code": 503}
+    if cv2 is None:
+        return {"error": "OpenCV not available", "status_code": 503}
     
     try:
-        # Read and process image
-        image_data = await file.read()
-        image_file = Image.open(io.BytesIO(image_data)).convert("RGB")
-        
-        # Preprocess image
-        processed_img = preprocess_image_for_caption(image_file)
+        # Read, decode and preprocess the image off the event loop
+        image_data = await read_capped(file)
+        if image_data is None:
+            return {"error": "Image file too large (max 5MB)", "status_code": 413}
+        processed_img = await run_blocking(decode_for_caption, image_data)
         if processed_img is None:
-            return {"error": "Failed to preprocess image", "status_code": 500}
+            return {"error": "Invalid image format", "status_code": 400}
         
-        # Extract features
-        image_features = extract_features(processed_img, feature_extractor)
-        if image_features is None:
+        # Extract features, batched with any concurrent caption requests
+        try:
+            image_features = await _FEATURE_BATCHER.predict(processed_img)
+        except Exception:
             return {"error": "Failed to extract image features", "status_code": 500}
         
         # Generate caption
-        caption = generate_caption(image_features)
+        caption = await run_blocking(generate_caption, image_features)
         caption = caption.replace("startseq", "").replace("endseq", "").strip()
         
         # Format caption: first letter capital, rest lowercase, add full stop
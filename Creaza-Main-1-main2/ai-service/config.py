@@ -0,0 +1,9 @@
+"""Service settings with no import side effects, so scripts can use them without workers"""
+import os
+from pathlib import Path
+
+# Per-process thread budget: the host's cores split across uvicorn workers (WEB_CONCURRENCY)
+CPU_THREADS = max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", "1")))
+
+# Model files, next to this module unless AI_MODEL_DIR points elsewhere
+MODEL_DIR = Path(os.getenv("AI_MODEL_DIR", Path(__file__).resolve().parent / "Models"))
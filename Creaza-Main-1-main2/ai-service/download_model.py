@@ -3,25 +3,105 @@
 Download LapSRN model for image enhancement
 """
 import os
+import hashlib
+import urllib.error
 import urllib.request
 
+from config import MODEL_DIR
+
 MODEL_URL = "https://github.com/fannymonori/TF-LapSRN/raw/master/export/LapSRN_x4.pb"
-MODEL_PATH = "LapSRN_x4.pb"
+MODEL_PATH = str(MODEL_DIR / "LapSRN_x4.pb")
+MODEL_SHA256 = "d3e95c93cafae5ce5a8ed57ce9abf07f2de58da8c5d6d656b766774969835ee2"
+MODEL_SIZE = 2712798
+CHUNK_SIZE = 1024 * 1024
+MAX_ATTEMPTS = 3
+
+def file_sha256(path):
+    """Return the hex SHA-256 digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def fetch_partial(url, partial_path):
+    """Stream url into partial_path, resuming from an existing partial file"""
+    digest = hashlib.sha256()
+    offset = 0
+    if os.path.exists(partial_path):
+        # Re-hash what we already have so the final digest covers the whole file
+        with open(partial_path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                offset += len(chunk)
+
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header("Range", f"bytes={offset}-")
+
+    try:
+        response = urllib.request.urlopen(request, timeout=30)
+    except urllib.error.HTTPError as e:
+        if offset and e.code == 416:
+            # Nothing past our offset: the partial file is already complete
+            return digest.hexdigest()
+        raise
+
+    with response:
+        if offset and response.status != 206:
+            # Server ignored the Range header, start over
+            digest = hashlib.sha256()
+            offset = 0
+        with open(partial_path, "ab" if offset else "wb") as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                f.write(chunk)
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+def finish_download(partial_path):
+    """Move a verified partial file into place"""
+    os.replace(partial_path, MODEL_PATH)
+    print(f"Model downloaded successfully: {MODEL_PATH}")
+    print(f"Model size: {os.path.getsize(MODEL_PATH) / 1024 / 1024:.1f} MB")
 
 def download_model():
     if os.path.exists(MODEL_PATH):
-        print(f"Model already exists: {MODEL_PATH}")
-        return
-    
+        if file_sha256(MODEL_PATH) == MODEL_SHA256:
+            print(f"Model already exists: {MODEL_PATH}")
+            return
+        print(f"Existing model failed checksum, downloading again: {MODEL_PATH}")
+        os.remove(MODEL_PATH)
+
     print(f"Downloading LapSRN model from {MODEL_URL}")
-    try:
-        urllib.request.urlretrieve(MODEL_URL, MODEL_PATH)
-        print(f"Model downloaded successfully: {MODEL_PATH}")
-        print(f"Model size: {os.path.getsize(MODEL_PATH) / 1024 / 1024:.1f} MB")
-    except Exception as e:
-        print(f"Failed to download model: {e}")
-        print("Please download manually from:")
-        print(MODEL_URL)
+    os.makedirs(MODEL_DIR, exist_ok=True)
+    partial_path = MODEL_PATH + ".partial"
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            digest = fetch_partial(MODEL_URL, partial_path)
+        except Exception as e:
+            print(f"Download attempt {attempt} failed: {e}")
+            continue
+
+        if digest != MODEL_SHA256:
+            print(f"Checksum mismatch on attempt {attempt} (got {digest})")
+            os.remove(partial_path)
+            continue
+
+        finish_download(partial_path)
+        return
+
+    # A short partial is kept so the next run can resume it; a full-length one is
+    # either the finished model or beyond repair
+    if os.path.exists(partial_path) and os.path.getsize(partial_path) >= MODEL_SIZE:
+        if file_sha256(partial_path) == MODEL_SHA256:
+            finish_download(partial_path)
+            return
+        os.remove(partial_path)
+
+    print("Failed to download model.")
+    print("Please download manually from:")
+    print(MODEL_URL)
 
 if __name__ == "__main__":
-    download_model()
\ No newline at end of file
+    download_model()
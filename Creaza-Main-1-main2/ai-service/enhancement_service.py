@@ -1,48 +1,120 @@
-import io
-import base64
 import numpy as np
-from PIL import Image
 import os
+import threading
+
+from workers import (
+    CPU_THREADS, MODEL_DIR, acquire_upload_buffer, read_capped, release_upload_buffer, run_blocking
+)
 
 try:
     import cv2
-    from cv2 import dnn_superres
 except ImportError:
     cv2 = None
-    dnn_superres = None
+
+# Tiling keeps LapSRN activations bounded regardless of input size
+SCALE = 4
+TILE_SIZE = 256
+TILE_OVERLAP = 16
+# Inputs beyond this are still downscaled: a 2048px side already gives an 8192px output
+MAX_INPUT_SIDE = int(os.getenv("LAPSRN_MAX_INPUT_SIDE", "2048"))
+
+# SR output is photographic, so JPEG is much cheaper to encode than PNG; png/webp are opt-in
+ENHANCE_OUTPUT_FORMAT = os.getenv("ENHANCE_OUTPUT_FORMAT", "jpeg").lower()
+JPEG_QUALITY = 92
+WEBP_QUALITY = 90
+PNG_COMPRESSION = 1
+
+LAPSRN_MODEL_PATH = MODEL_DIR / "LapSRN_x4.pb"
+# Checked once, /model-status is polled
+_MODEL_EXISTS = LAPSRN_MODEL_PATH.exists()
 
 # Global variables
 lapsrn_model_loaded = False
+_SR_INSTANCE = None
+# OpenCV DNN nets are not safe to run concurrently
+_SR_LOCK = threading.Lock()
+
+class LapSRNUpsampler:
+    """LapSRN on a plain cv2.dnn Net, producing the same output as DnnSuperResImpl.upsample
+
+    Like dnn_superres, only the Y channel goes through the network and CrCb is
+    upscaled bilinearly, but the input blob buffer is reused between calls.
+    """
+
+    def __init__(self, model_path, scale=SCALE):
+        # The LapSRN graph's DepthToSpace ops need the layer dnn_superres registers
+        # when its first instance is created; stock dnn rejects them (no blocksize)
+        cv2.dnn_superres.DnnSuperResImpl_create()
+        self.net = cv2.dnn.readNetFromTensorflow(model_path)
+        self.scale = scale
+        self._blob = np.empty(0, dtype=np.float32)
+
+    def setPreferableBackend(self, backend):
+        self.net.setPreferableBackend(backend)
+
+    def setPreferableTarget(self, target):
+        self.net.setPreferableTarget(target)
+
+    def upsample(self, image):
+        h, w = image.shape[:2]
+        ycrcb = cv2.cvtColor(image, cv2.COLOR_BGR2YCrCb).astype(np.float32)
+        ycrcb *= 1 / 255.0
+        
+        # Grow the flat buffer only when needed; a prefix reshaped is still contiguous
+        if self._blob.size < h * w:
+            self._blob = np.empty(h * w, dtype=np.float32)
+        blob = self._blob[:h * w].reshape(1, 1, h, w)
+        np.copyto(blob[0, 0], ycrcb[:, :, 0])
+        
+        self.net.setInput(blob)
+        y = self.net.forward()
+        
+        # Network output replaces Y, chroma is just resized
+        upscaled = cv2.resize(ycrcb, (w * self.scale, h * self.scale), interpolation=cv2.INTER_LINEAR)
+        upscaled[:, :, 0] = y[0, 0]
+        upscaled *= 255.0
+        np.rint(upscaled, out=upscaled)
+        np.clip(upscaled, 0, 255, out=upscaled)
+        return cv2.cvtColor(upscaled.astype(np.uint8), cv2.COLOR_YCrCb2BGR)
 
 def check_lapsrn_model():
     """Check if LapSRN model is available and loadable"""
-    global lapsrn_model_loaded
+    global lapsrn_model_loaded, _SR_INSTANCE
     
-    if cv2 is None or dnn_superres is None:
-        print("❌ OpenCV or dnn_superres not available - image enhancement disabled")
+    if cv2 is None:
+        print("❌ OpenCV not available - image enhancement disabled")
         return False
     
-    model_path = "LapSRN_x4.pb"
-    
     # Check if model file exists
-    if not os.path.exists(model_path):
-        print(f"❌ LapSRN model not found at: {model_path}")
+    if not _MODEL_EXISTS:
+        print(f"❌ LapSRN model not found at: {LAPSRN_MODEL_PATH}")
         return False
     
     try:
         # Try to load the model
-        sr = dnn_superres.DnnSuperResImpl_create()
-        sr.readModel(model_path)
-        sr.setModel('lapsrn', 4)
+        sr = LapSRNUpsampler(str(LAPSRN_MODEL_PATH), SCALE)
         
-        # Test with a small dummy image
-        test_img = np.zeros((32, 32, 3), dtype=np.uint8)
-        sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_DEFAULT)
-        sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        # Set CUDA backend if available
+        if CUDA_AVAILABLE:
+            try:
+                sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
+                sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
+                print("✅ Using GPU (CUDA) for upscaling.")
+            except Exception:
+                sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_DEFAULT)
+                sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+                print("⚠️ CUDA detected but not usable. Falling back to CPU.")
+        else:
+            sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_DEFAULT)
+            sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+            print("⚠️ Using CPU for upscaling.")
         
         # Try a small upsampling test
+        test_img = np.zeros((32, 32, 3), dtype=np.uint8)
         _ = sr.upsample(test_img)
         
+        # Keep the configured instance so requests don't reload the model
+        _SR_INSTANCE = sr
         lapsrn_model_loaded = True
         print("✅ LapSRN model loaded and tested successfully")
         return True
@@ -63,55 +135,79 @@ def can_use_cuda():
         pass
     return False
 
-def enhance_image_lapsrn(image_data: bytes) -> bytes:
-    """Enhance image using LapSRN model with exact original logic"""
-    MODEL_PATH = "LapSRN_x4.pb"
-    MODEL_NAME = 'lapsrn'
-    SCALE = 4
+# getBuildInformation() is a large string, so only inspect it once
+CUDA_AVAILABLE = cv2 is not None and can_use_cuda()
+
+if cv2 is not None:
+    cv2.setNumThreads(CPU_THREADS)
+    if not CUDA_AVAILABLE:
+        # CPU-only: skip OpenCL device discovery and the T-API dispatch overhead
+        cv2.ocl.setUseOpenCL(False)
+
+def upsample_tiled(sr, image, lock, scale=SCALE, tile=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Upsample image with sr in overlapping tiles, stitching the tile centres
+
+    lock is held per tile, so concurrent requests interleave instead of a large
+    image holding the model for its whole duration.
+    """
+    h, w = image.shape[:2]
+    if h <= tile and w <= tile:
+        with lock:
+            return sr.upsample(image)
+    
+    # Reflect-pad so every tile, including edge tiles, has a full halo of context
+    padded = cv2.copyMakeBorder(image, overlap, overlap, overlap, overlap, cv2.BORDER_REFLECT_101)
+    upscaled = np.empty((h * scale, w * scale, 3), dtype=np.uint8)
     
-    if not os.path.isfile(MODEL_PATH):
-        raise FileNotFoundError(f"Model not found: {MODEL_PATH}")
+    for y in range(0, h, tile):
+        for x in range(0, w, tile):
+            th, tw = min(tile, h - y), min(tile, w - x)
+            patch = padded[y:y + th + 2 * overlap, x:x + tw + 2 * overlap]
+            with lock:
+                up = sr.upsample(patch)
+            # Drop the upscaled halo, keeping only the tile centre
+            upscaled[y * scale:(y + th) * scale, x * scale:(x + tw) * scale] = \
+                up[overlap * scale:(overlap + th) * scale, overlap * scale:(overlap + tw) * scale]
+    
+    return upscaled
+
+def encode_enhanced(image):
+    """Encode the upscaled image in ENHANCE_OUTPUT_FORMAT, returning (buffer, mime type)"""
+    if ENHANCE_OUTPUT_FORMAT == "png":
+        # Level 1 is several times faster than the default 3 for a few % more bytes
+        ok, buffer = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION])
+        mime_type = "image/png"
+    elif ENHANCE_OUTPUT_FORMAT == "webp":
+        ok, buffer = cv2.imencode('.webp', image, [cv2.IMWRITE_WEBP_QUALITY, WEBP_QUALITY])
+        mime_type = "image/webp"
+    else:
+        ok, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY, cv2.IMWRITE_JPEG_OPTIMIZE, 0])
+        mime_type = "image/jpeg"
+    if not ok:
+        raise Exception("Could not encode enhanced image")
+    return buffer, mime_type
+
+def enhance_image_lapsrn(image_data):
+    """Enhance image using LapSRN model with exact original logic
+
+    Returns (buffer, mime_type), or None when the data does not decode as an image.
+    """
+    if _SR_INSTANCE is None:
+        raise Exception("LapSRN model not loaded")
     
     # Decode image
     nparr = np.frombuffer(image_data, np.uint8)
     image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     
     if image is None:
-        raise Exception("Could not read image")
+        return None
     
     print(f"🖼️ Original image: {image.shape[1]}x{image.shape[0]} pixels")
     
-    # Create SR object
-    sr = dnn_superres.DnnSuperResImpl_create()
-    
-    # Load model
-    try:
-        sr.readModel(MODEL_PATH)
-    except cv2.error as e:
-        raise Exception(f"Failed to read model: {e}")
-    
-    # Set model and scale
-    sr.setModel(MODEL_NAME, SCALE)
-    
-    # Set CUDA backend if available
-    if can_use_cuda():
-        try:
-            sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
-            sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
-            print("✅ Using GPU (CUDA) for upscaling.")
-        except Exception:
-            sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_DEFAULT)
-            sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
-            print("⚠️ CUDA detected but not usable. Falling back to CPU.")
-    else:
-        sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_DEFAULT)
-        sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
-        print("⚠️ Using CPU for upscaling.")
-    
-    # Memory safety - resize if too large
+    # Memory safety - resize only if the 4x output would be huge
     h, w = image.shape[:2]
-    if w > 400 or h > 400:
-        scale_factor = min(400 / w, 400 / h)
+    if w > MAX_INPUT_SIDE or h > MAX_INPUT_SIDE:
+        scale_factor = min(MAX_INPUT_SIDE / w, MAX_INPUT_SIDE / h)
         new_w, new_h = int(w * scale_factor), int(h * scale_factor)
         image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
         print(f"🔄 Resized for processing: {new_w}x{new_h}")
@@ -119,14 +215,13 @@ def enhance_image_lapsrn(image_data: bytes) -> bytes:
     # Upscale using LapSRN
     try:
         print("⏳ Upscaling... (may take a few seconds on CPU)")
-        upscaled = sr.upsample(image)
+        upscaled = upsample_tiled(_SR_INSTANCE, image, _SR_LOCK)
         print(f"✅ Upscaling finished: {upscaled.shape[1]}x{upscaled.shape[0]}")
     except cv2.error as e:
         raise Exception(f"Upscaling failed: {e}")
     
-    # Encode to bytes
-    _, buffer = cv2.imencode('.png', upscaled)
-    return buffer.tobytes()
+    # Encode
+    return encode_enhanced(upscaled)
 
 def fit_window_cv2(img, max_width=1600, max_height=900):
     """Resize image to fit inside a window while preserving aspect ratio"""
@@ -137,54 +232,67 @@ def fit_window_cv2(img, max_width=1600, max_height=900):
     new_w, new_h = int(w * scale), int(h * scale)
     return cv2.resize(img, (new_w, new_h), interpolation=cv2.INTER_AREA)
 
+def sniff_image_format(data):
+    """Identify PNG/JPEG/WebP uploads from their first bytes, None otherwise"""
+    header = bytes(data[:12])
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    return None
+
 async def enhance_image(file):
     """Enhance image using LapSRN 4x super-resolution"""
+    buf = acquire_upload_buffer()
     try:
         print(f"📸 Enhancement request received for file: {file.filename}")
-        contents = await file.read()
-        print(f"📏 File size: {len(contents)} bytes")
-        
-        if len(contents) > 5 * 1024 * 1024:
+        contents = await read_capped(file, buf=buf)
+        if contents is None:
             return {"error": "Image file too large (max 5MB)", "status_code": 413}
+        print(f"📏 File size: {len(contents)} bytes")
         
         # Check if required libraries are available
-        if cv2 is None or dnn_superres is None:
-            return {"error": "OpenCV with dnn_superres not available", "status_code": 503}
+        if cv2 is None:
+            return {"error": "OpenCV not available", "status_code": 503}
         
         # Check if LapSRN model is available
         if not lapsrn_model_loaded:
             return {"error": "LapSRN model not available", "status_code": 503}
         
-        # Validate image format
-        try:
-            test_img = Image.open(io.BytesIO(contents))
-            test_img.verify()
-        except Exception:
+        # Validate image format from the header only; corrupt bodies fail in cv2.imdecode
+        if sniff_image_format(contents) is None:
             return {"error": "Invalid image format", "status_code": 400}
         
-        # Use LapSRN for enhancement
-        enhanced_bytes = enhance_image_lapsrn(contents)
+        # Use LapSRN for enhancement (decode, upsample and encode off the event loop)
+        result = await run_blocking(enhance_image_lapsrn, contents)
+        if result is None:
+            # Valid header but a body cv2 can't decode
+            return {"error": "Invalid image format", "status_code": 400}
+        enhanced, mime_type = result
         
-        # Convert to base64
-        img_str = base64.b64encode(enhanced_bytes).decode()
-        print(f"📤 Base64 encoded, length: {len(img_str)} chars")
+        print(f"📤 Encoded {mime_type}, {enhanced.nbytes} bytes")
         
         return {
             "success": True,
-            "image": f"data:image/png;base64,{img_str}",
+            "image_bytes": enhanced,
+            "media_type": mime_type,
             "message": "Image enhanced 4x using LapSRN super-resolution"
         }
         
     except Exception as e:
         print(f"❌ Enhancement error: {str(e)}")
         return {"error": f"Enhancement failed: {str(e)}", "status_code": 500}
+    finally:
+        release_upload_buffer(buf)
 
 def get_enhancement_status():
     """Get enhancement model status"""
     return {
         "lapsrn_model": {
             "loaded": lapsrn_model_loaded,
-            "path": "LapSRN_x4.pb",
-            "exists": os.path.exists("LapSRN_x4.pb")
+            "path": str(LAPSRN_MODEL_PATH),
+            "exists": _MODEL_EXISTS
         }
     }
\ No newline at end of file
@@ -1,9 +1,18 @@
 import cv2
-from cv2 import dnn_superres
 import os
+import threading
 import numpy as np
 from typing import Tuple
 
+from enhancement_service import LAPSRN_MODEL_PATH, LapSRNUpsampler, upsample_tiled, MAX_INPUT_SIDE
+
+MODEL_PATH = str(LAPSRN_MODEL_PATH)
+SCALE = 4
+
+# SR object is built once on first use and shared between calls
+_SR_INSTANCE = None
+_SR_LOCK = threading.Lock()
+
 def can_use_cuda():
     """Return True if the current OpenCV build supports CUDA DNN target."""
     try:
@@ -16,29 +25,26 @@ def can_use_cuda():
         pass
     return False
 
-def enhance_image_4x(image: np.ndarray, original_size: Tuple[int, int]) -> np.ndarray:
-    """Enhance image 4x using exact original code logic"""
-    MODEL_PATH = r'C:\Users\nilab\OneDrive\Desktop\Project25\Image-EDit\Creaza-Main-1-main2\ai-service\Models\LapSRN_x4.pb'
-    MODEL_NAME = 'lapsrn'
-    SCALE = 4
+# getBuildInformation() is a large string, so only inspect it once
+CUDA_AVAILABLE = can_use_cuda()
+
+def get_sr_instance():
+    """Return the shared LapSRN SR object, loading it on first call"""
+    global _SR_INSTANCE
+    if _SR_INSTANCE is not None:
+        return _SR_INSTANCE
     
     if not os.path.isfile(MODEL_PATH):
         raise FileNotFoundError(f"Model not found: {MODEL_PATH}")
     
-    # Create SR object
-    sr = dnn_superres.DnnSuperResImpl_create()
-    
     # Load model
     try:
-        sr.readModel(MODEL_PATH)
+        sr = LapSRNUpsampler(MODEL_PATH, SCALE)
     except cv2.error as e:
         raise Exception(f"Failed to read model: {e}")
     
-    # Set model and scale
-    sr.setModel(MODEL_NAME, SCALE)
-    
     # Set CUDA backend if available
-    if can_use_cuda():
+    if CUDA_AVAILABLE:
         try:
             sr.setPreferableBackend(cv2.dnn.DNN_BACKEND_CUDA)
             sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CUDA)
@@ -52,17 +58,25 @@ def enhance_image_4x(image: np.ndarray, original_size: Tuple[int, int]) -> np.nd
         sr.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
         print("⚠️ OpenCV not built with CUDA support. Using CPU.")
     
-    # Memory check - resize if too large
+    _SR_INSTANCE = sr
+    return sr
+
+def enhance_image_4x(image: np.ndarray, original_size: Tuple[int, int]) -> np.ndarray:
+    """Enhance image 4x using exact original code logic"""
+    with _SR_LOCK:
+        sr = get_sr_instance()
+    
+    # Memory check - resize only if the 4x output would be huge
     h, w = image.shape[:2]
-    if w > 400 or h > 400:
-        scale_factor = min(400 / w, 400 / h)
+    if w > MAX_INPUT_SIDE or h > MAX_INPUT_SIDE:
+        scale_factor = min(MAX_INPUT_SIDE / w, MAX_INPUT_SIDE / h)
         new_w, new_h = int(w * scale_factor), int(h * scale_factor)
         image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_AREA)
     
     # Upscale
     try:
         print("⏳ Upscaling... (may take a few seconds on CPU)")
-        upscaled = sr.upsample(image)
+        upscaled = upsample_tiled(sr, image, _SR_LOCK, scale=SCALE)
         print("✅ Upscaling finished.")
     except cv2.error as e:
         raise Exception(f"Upscaling failed: {e}")
@@ -82,5 +96,5 @@ def enhance_image_api(image_data: bytes, target_width: int, target_height: int,
     
     result = enhance_image_4x(image, (target_width, target_height))
     
-    _, buffer = cv2.imencode('.png', result)
+    _, buffer = cv2.imencode('.png', result, [cv2.IMWRITE_PNG_COMPRESSION, 1])
     return buffer.tobytes()
\ No newline at end of file
@@ -1,8 +1,13 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+# Sets the BLAS/OpenMP thread budget, so it has to come before anything that loads numpy
+import workers  # noqa: F401
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response
 from pydantic import BaseModel
+from typing import Literal
 import uvicorn
-import requests
+import asyncio
+from urllib.parse import quote
 
 # Import our service modules
 from caption_service import (
@@ -15,14 +20,16 @@ from background_service import (
     blur_background, 
     custom_background_color, 
     custom_background_image,
-    get_background_status
+    get_background_status,
+    warm_rembg
 )
 from enhancement_service import (
     check_lapsrn_model, 
     enhance_image,
     get_enhancement_status
 )
-from text_to_image_service import generate_text_to_image
+from text_to_image_service import generate_text_to_image, get_text_to_image_status, load_local_flux
+from workers import HTTP_CLIENT, json_bytes, run_blocking, to_data_uri
 
 app = FastAPI(title="Image Editor AI Service", version="1.0.0")
 
@@ -33,6 +40,8 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["GET", "POST", "OPTIONS"],
     allow_headers=["*"],
+    # Binary image responses carry their metadata in X- headers
+    expose_headers=["*"],
 )
 
 # API Keys and Chat Service Configuration
@@ -44,18 +53,48 @@ CHAT_MODELS = {
     "glm-4.5-air": "z-ai/glm-4.5-air:free"
 }
 
+# ?response_format= on the image endpoints; anything else is a 422
+ResponseFormat = Literal["json", "binary"]
+
 class TextToImageRequest(BaseModel):
     prompt: str
     width: int = 512
     height: int = 512
     num_inference_steps: int = 50
     guidance_scale: float = 12.0
+    # "bytes" returns the PNG itself, same as ?response_format=binary
+    return_format: Literal["data_uri", "bytes"] = "data_uri"
 
 class ChatRequest(BaseModel):
     message: str
     model: str = "llama-4-maverick"
     history: list = []
 
+async def image_response(result, response_format):
+    """Render an image result as JSON with a data URI, or as the raw image with response_format=binary"""
+    image, media_type = result.pop("image_bytes"), result.pop("media_type")
+    if response_format == "binary":
+        # Skips base64 entirely; the other fields travel as (percent-encoded) headers
+        headers = {f"X-{key.replace('_', '-').title()}": quote(str(value)) for key, value in result.items()}
+        return Response(content=bytes(image), media_type=media_type, headers=headers)
+    result["image"] = await run_blocking(to_data_uri, image, media_type)
+    return result
+
+@app.on_event("startup")
+async def load_models():
+    """Load and warm every model in parallel so the first requests don't pay for it"""
+    await asyncio.gather(
+        asyncio.to_thread(load_caption_model),
+        asyncio.to_thread(check_lapsrn_model),
+        asyncio.to_thread(warm_rembg),
+        asyncio.to_thread(load_local_flux),
+    )
+
+@app.on_event("shutdown")
+async def close_http_client():
+    """Close pooled outbound connections"""
+    await HTTP_CLIENT.aclose()
+
 @app.get("/")
 async def root():
     return {"message": "Image Editor AI Service", "status": "running"}
@@ -67,6 +106,7 @@ async def model_status():
     status.update(get_caption_status())
     status.update(get_background_status())
     status.update(get_enhancement_status())
+    status.update(get_text_to_image_status())
     return status
 
 @app.get("/chat/models")
@@ -143,10 +183,10 @@ Provide step-by-step guidance using only our available tools and features."""
             "temperature": 0.7
         }
         
-        response = requests.post(
+        response = await HTTP_CLIENT.post(
             "https://openrouter.ai/api/v1/chat/completions",
             headers=headers,
-            json=payload
+            content=json_bytes(payload)
         )
         
         print(f"API Response Status: {response.status_code}")
@@ -193,64 +233,67 @@ async def generate_image_caption(file: UploadFile = File(...)):
     return result
 
 @app.post("/remove-background")
-async def remove_background_endpoint(file: UploadFile = File(...)):
+async def remove_background_endpoint(file: UploadFile = File(...), response_format: ResponseFormat = Query("json")):
     """Remove background from uploaded image using rembg"""
     result = await remove_background(file)
     if "error" in result:
         raise HTTPException(status_code=result["status_code"], detail=result["error"])
-    return result
+    return await image_response(result, response_format)
 
 @app.post("/blur-background")
-async def blur_background_endpoint(file: UploadFile = File(...)):
+async def blur_background_endpoint(file: UploadFile = File(...), response_format: ResponseFormat = Query("json")):
     """Blur background of uploaded image using rembg and OpenCV"""
     result = await blur_background(file)
     if "error" in result:
         raise HTTPException(status_code=result["status_code"], detail=result["error"])
-    return result
+    return await image_response(result, response_format)
 
 @app.post("/custom-background")
-async def custom_background_endpoint(file: UploadFile = File(...), color: str = Form("#FFFFFF")):
+async def custom_background_endpoint(
+    file: UploadFile = File(...), 
+    color: str = Form("#FFFFFF"), 
+    response_format: ResponseFormat = Query("json")
+):
     """Replace background with custom color using rembg"""
     result = await custom_background_color(file, color)
     if "error" in result:
         raise HTTPException(status_code=result["status_code"], detail=result["error"])
-    return result
+    return await image_response(result, response_format)
 
 @app.post("/custom-background-image")
 async def custom_background_image_endpoint(
     file: UploadFile = File(...), 
-    background: UploadFile = File(...)
+    background: UploadFile = File(...), 
+    response_format: ResponseFormat = Query("json")
 ):
     """Replace background with custom uploaded image using rembg"""
     result = await custom_background_image(file, background)
     if "error" in result:
         raise HTTPException(status_code=result["status_code"], detail=result["error"])
-    return result
+    return await image_response(result, response_format)
 
 @app.post("/enhance-image")
-async def enhance_image_endpoint(file: UploadFile = File(...)):
+async def enhance_image_endpoint(file: UploadFile = File(...), response_format: ResponseFormat = Query("json")):
     """Enhance image using LapSRN 4x super-resolution"""
     result = await enhance_image(file)
     if "error" in result:
         raise HTTPException(status_code=result["status_code"], detail=result["error"])
-    return result
+    return await image_response(result, response_format)
 
 @app.post("/text-to-image")
-async def text_to_image(request: TextToImageRequest):
-    """Generate image from text using Black Forest Labs FLUX.1-schnell via Hugging Face API"""
+async def text_to_image(request: TextToImageRequest, response_format: ResponseFormat = Query("json")):
+    """Generate image from text using Black Forest Labs FLUX.1-schnell (local GPU or Hugging Face API)"""
     result = await generate_text_to_image(request)
     if "error" in result:
         raise HTTPException(status_code=result["status_code"], detail=result["error"])
-    return result
+    if request.return_format == "bytes":
+        response_format = "binary"
+    return await image_response(result, response_format)
 
 if __name__ == "__main__":
     print("Starting Image Editor AI Service...")
     
-    # Load caption model on startup
-    load_caption_model()
-    
-    # Check LapSRN model on startup
-    check_lapsrn_model()
+    # Models are loaded by the startup event once uvicorn starts
     
     print("Available endpoints:")
     print("   - GET /chat/models (Get available chat models)")
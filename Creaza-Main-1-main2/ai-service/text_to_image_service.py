@@ -1,73 +1,330 @@
-import base64
-import requests
+import asyncio
+import itertools
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+import httpx
+
+from workers import HTTP_CLIENT, get_logger, json_bytes, pooled_bytesio, run_blocking, written_view
+
+try:
+    import torch
+    from diffusers import FluxPipeline
+except ImportError:
+    torch = None
+    FluxPipeline = None
+
+logger = get_logger(__name__)
 
 # Global variables
-HF_API_KEYS = [
-    ""
-]
-current_key_index = 0
+# Comma-separated so several keys can share the rate limit, e.g. HF_API_KEYS=hf_a,hf_b
+HF_API_KEYS = [key.strip() for key in os.getenv("HF_API_KEYS", "").split(",") if key.strip()]
 HF_MODEL = "black-forest-labs/FLUX.1-schnell"
 HF_API_URL = f"https://api-inference.huggingface.co/models/{HF_MODEL}"
+# Generation can legitimately take a while, but a dead connection should fail fast
+HF_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+MAX_BACKOFF = 30
+# Even a single key gets a couple of backed-off retries
+MIN_ATTEMPTS = 3
+# Start the next key if no answer arrived within this many seconds. Each hedge is a
+# duplicate generation against another key's quota, so this sits above typical latency.
+HF_HEDGE_DELAY = float(os.getenv("HF_HEDGE_DELAY", "5"))
+# Longest a request will sit waiting out a key's cooldown; keys cooling for longer are
+# skipped, and a request with no usable key fails fast with a 429
+HF_MAX_KEY_WAIT = float(os.getenv("HF_MAX_KEY_WAIT", "10"))
 
-def get_next_api_key():
-    """Rotate to next API key"""
-    global current_key_index
-    current_key_index = (current_key_index + 1) % len(HF_API_KEYS)
-    return HF_API_KEYS[current_key_index]
+# In-process FLUX on a CUDA GPU instead of the API (opt-in: the weights are ~24GB)
+FLUX_LOCAL = os.getenv("FLUX_LOCAL", "0") == "1"
+# schnell is distilled for few-step sampling without classifier-free guidance
+FLUX_MAX_STEPS = 4
+_FLUX_PIPE = None
+# One generation at a time on the GPU
+_FLUX_LOCK = threading.Lock()
 
-def get_current_api_key():
-    """Get current API key"""
-    return HF_API_KEYS[current_key_index]
+# Recent generations by prompt and parameters, so repeats skip inference entirely.
+# Most-recently-used last; entries expire after T2I_CACHE_TTL seconds.
+T2I_CACHE_SIZE = int(os.getenv("T2I_CACHE_SIZE", "128"))
+T2I_CACHE_TTL = float(os.getenv("T2I_CACHE_TTL", str(24 * 60 * 60)))
+_image_cache = OrderedDict()
+# Generations in progress by the same key; identical concurrent requests share one
+_in_flight = {}
 
-async def generate_text_to_image(request):
-    """Generate image from text using Black Forest Labs FLUX.1-schnell via Hugging Face API"""
-    max_retries = len(HF_API_KEYS)
+# Keys that hit a rate limit are skipped until this time.monotonic() deadline
+_key_cooldown_until = {}
+# Each request starts on the next key in turn, spreading load across all keys
+_key_counter = itertools.count()
+_key_counter_lock = threading.Lock()
+# Per-key request headers; see api_headers()
+_HEADERS_BY_KEY = {}
+
+def key_order():
+    """Key indices to try, starting at the next key in the round-robin; keys cooling down go last"""
+    with _key_counter_lock:
+        start = next(_key_counter) % len(HF_API_KEYS)
+    rotation = [(start + i) % len(HF_API_KEYS) for i in range(len(HF_API_KEYS))]
+    # sorted() is stable, so keys that are free keep their rotation order
+    return sorted(rotation, key=key_wait)
+
+def retry_after_seconds(value):
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+def cool_down_key(key, attempt, retry_after=None):
+    """Back off a rate-limited key, returning the delay
+
+    The server's Retry-After wins when it sends one; otherwise the delay
+    is exponential in the attempt number. Either way it is capped at
+    MAX_BACKOFF, and jitter is added so keys don't all come back at once.
+    """
+    delay = retry_after_seconds(retry_after)
+    if delay is None:
+        delay = 2 ** attempt
+    delay = min(delay, MAX_BACKOFF) + random.uniform(0, 1)
+    _key_cooldown_until[key] = time.monotonic() + delay
+    return delay
+
+def key_wait(index):
+    """Seconds left on a key's cooldown (0 when it is usable now)"""
+    return max(_key_cooldown_until.get(HF_API_KEYS[index], 0) - time.monotonic(), 0)
+
+def api_headers(key):
+    """Request headers for one API key, built once per key"""
+    headers = _HEADERS_BY_KEY.get(key)
+    if headers is None:
+        headers = _HEADERS_BY_KEY[key] = {
+            "Authorization": f"Bearer {key}",
+            "Content-Type": "application/json",
+            # Ask for the raw image rather than letting the API pick a wrapper
+            "Accept": "image/png"
+        }
+    return headers
+
+async def post_with_key(index, payload):
+    """POST a serialized generation payload with one key, waiting out its cooldown first"""
+    wait = key_wait(index)
+    if wait > 0:
+        logger.info("API key %d rate limited, waiting %.1fs", index + 1, wait)
+        await asyncio.sleep(wait)
+    return await HTTP_CLIENT.post(HF_API_URL, headers=api_headers(HF_API_KEYS[index]), content=payload, timeout=HF_TIMEOUT)
+
+async def hedged_post(payload):
+    """Try keys with hedging, returning (response, error message, status code)
+
+    The next key is started when one fails, or when the in-flight attempts
+    have run for HF_HEDGE_DELAY without answering. The first 200 wins and the
+    rest are cancelled. Keys cooling down for longer than HF_MAX_KEY_WAIT are
+    skipped rather than waited on.
+    """
+    order = key_order()
+    # Even a single key gets MIN_ATTEMPTS tries, repeating keys in order
+    attempts = [order[i % len(order)] for i in range(max(len(order), MIN_ATTEMPTS))]
+    in_flight = {}  # task -> (key index, attempt number)
+    launched = 0
+    error, status_code = "All API keys exhausted", 500
     
-    for attempt in range(max_retries):
-        try:
-            current_key = get_current_api_key()
-            print(f"Generating: {request.prompt} (attempt {attempt + 1})")
-            
-            headers = {
-                "Authorization": f"Bearer {current_key}",
-                "Content-Type": "application/json"
-            }
-            
-            payload = {
-                "inputs": request.prompt,
-                "parameters": {
-                    "width": request.width,
-                    "height": request.height,
-                    "num_inference_steps": request.num_inference_steps,
-                    "guidance_scale": request.guidance_scale
-                }
-            }
+    try:
+        while attempts or in_flight:
+            while attempts and key_wait(attempts[0]) > HF_MAX_KEY_WAIT:
+                logger.info("Skipping API key %d, rate limited for %.0fs", attempts[0] + 1, key_wait(attempts[0]))
+                attempts.pop(0)
+                error, status_code = "All API keys are rate limited, try again later", 429
+            if not attempts and not in_flight:
+                break
             
-            response = requests.post(HF_API_URL, headers=headers, json=payload)
+            # A key is never in flight twice; repeats wait for its previous attempt
+            can_launch = bool(attempts) and attempts[0] not in [i for i, _ in in_flight.values()]
+            if can_launch:
+                index = attempts.pop(0)
+                logger.info("Trying API key %d (attempt %d)", index + 1, launched + 1)
+                in_flight[asyncio.create_task(post_with_key(index, payload))] = (index, launched)
+                launched += 1
+                can_launch = bool(attempts) and attempts[0] not in [i for i, _ in in_flight.values()]
             
-            if response.status_code == 200:
-                # Convert response to base64
-                img_str = base64.b64encode(response.content).decode()
+            done, _ = await asyncio.wait(
+                in_flight, timeout=(HF_HEDGE_DELAY or None) if can_launch else None, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                index, attempt = in_flight.pop(task)
+                try:
+                    response = task.result()
+                except httpx.HTTPError as e:
+                    logger.warning("Request failed with key %d: %s", index + 1, e)
+                    error, status_code = f"All API keys failed: {str(e)}", 500
+                    continue
                 
-                return {
-                    "success": True,
-                    "image": f"data:image/png;base64,{img_str}",
-                    "prompt": request.prompt,
-                    "message": "Image generated successfully"
-                }
-            elif response.status_code in [429, 503, 401]:  # Rate limit, service unavailable, or unauthorized
-                print(f"API key {current_key_index + 1} failed: {response.status_code}. Trying next key...")
-                get_next_api_key()  # Switch to next key
-                continue
-            else:
-                return {"error": f"API request failed: {response.text}", "status_code": response.status_code}
-                
-        except requests.exceptions.RequestException as e:
-            print(f"Request failed with key {current_key_index + 1}: {str(e)}")
-            if attempt < max_retries - 1:
-                get_next_api_key()  # Switch to next key
-                continue
-            else:
-                return {"error": f"All API keys failed: {str(e)}", "status_code": 500}
+                if response.status_code == 200:
+                    return response, None, 200
+                if response.status_code in [429, 503, 401]:  # Rate limit, service unavailable, or unauthorized
+                    logger.warning("API key %d failed: %d. Trying next key...", index + 1, response.status_code)
+                    if response.status_code in (429, 503):
+                        cool_down_key(HF_API_KEYS[index], attempt, response.headers.get("retry-after"))
+                        error, status_code = "All API keys are rate limited, try again later", 429
+                    continue
+                return response, f"API request failed: {response.text}", response.status_code
+    finally:
+        for task in in_flight:
+            task.cancel()
+    
+    return None, error, status_code
+
+def load_local_flux():
+    """Load FLUX.1-schnell onto the GPU when FLUX_LOCAL=1 and CUDA is available"""
+    global _FLUX_PIPE
+    if not FLUX_LOCAL:
+        return False
+    if FluxPipeline is None or not torch.cuda.is_available():
+        logger.warning("⚠️ FLUX_LOCAL set but diffusers/CUDA unavailable - using Hugging Face API")
+        return False
+    try:
+        pipe = FluxPipeline.from_pretrained(HF_MODEL, torch_dtype=torch.bfloat16)
+        # Keep transformer weights in FP8, upcast per layer for bf16 compute (halves weight memory/bandwidth)
+        if hasattr(pipe.transformer, "enable_layerwise_casting"):
+            pipe.transformer.enable_layerwise_casting(storage_dtype=torch.float8_e4m3fn, compute_dtype=torch.bfloat16)
+        _FLUX_PIPE = pipe.to("cuda")
+        logger.info("✅ FLUX.1-schnell loaded on GPU")
+        return True
+    except Exception as e:
+        logger.error("❌ Failed to load local FLUX pipeline: %s", e)
+        return False
+
+def generate_local(request):
+    """Run the local FLUX pipeline and return the PNG bytes"""
+    with _FLUX_LOCK:
+        image = _FLUX_PIPE(
+            request.prompt,
+            num_inference_steps=min(request.num_inference_steps, FLUX_MAX_STEPS),
+            guidance_scale=0.0,
+            height=request.height,
+            width=request.width,
+        ).images[0]
+    with pooled_bytesio() as img_buffer:
+        image.save(img_buffer, format='PNG', compress_level=1)
+        with written_view(img_buffer) as data:
+            return bytes(data)
+
+def cache_key(request):
+    """Everything that determines the generated image"""
+    return (request.prompt, request.width, request.height, request.num_inference_steps, request.guidance_scale)
+
+def cached_image(key):
+    """(image bytes, media type) for a cached generation, or None"""
+    entry = _image_cache.get(key)
+    if entry is None:
+        return None
+    image_bytes, media_type, created = entry
+    if time.monotonic() - created > T2I_CACHE_TTL:
+        del _image_cache[key]
+        return None
+    _image_cache.move_to_end(key)
+    return image_bytes, media_type
+
+def cache_image(key, image_bytes, media_type):
+    """Remember a generation, evicting the least recently used past T2I_CACHE_SIZE"""
+    if T2I_CACHE_SIZE <= 0:
+        return
+    _image_cache[key] = (image_bytes, media_type, time.monotonic())
+    _image_cache.move_to_end(key)
+    while len(_image_cache) > T2I_CACHE_SIZE:
+        _image_cache.popitem(last=False)
+
+async def generate_text_to_image(request):
+    """Generate image from text, returning a cached image for a repeated request"""
+    key = cache_key(request)
+    cached = cached_image(key)
+    if cached is not None:
+        logger.info("Cache hit: %s", request.prompt)
+        image_bytes, media_type = cached
+        return {
+            "success": True,
+            "image_bytes": image_bytes,
+            "media_type": media_type,
+            "prompt": request.prompt,
+            "message": "Image generated successfully"
+        }
     
-    return {"error": "All API keys exhausted", "status_code": 500}
\ No newline at end of file
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(generate_and_cache(key, request))
+        _in_flight[key] = task
+    else:
+        logger.info("Joining in-flight generation: %s", request.prompt)
+    # Shielded so one caller disconnecting doesn't cancel the generation for the others
+    result = await asyncio.shield(task)
+    # Callers pop fields off the result, so each gets its own copy
+    return dict(result)
+
+async def generate_and_cache(key, request):
+    """Run one shared generation, caching it even if every caller has gone away"""
+    try:
+        result = await generate_uncached(request)
+        if "error" not in result:
+            cache_image(key, result["image_bytes"], result["media_type"])
+        return result
+    finally:
+        # No await between caching and this, so a new request sees one or the other
+        _in_flight.pop(key, None)
+
+async def generate_uncached(request):
+    """Generate image from text using Black Forest Labs FLUX.1-schnell (local GPU or Hugging Face API)"""
+    if _FLUX_PIPE is not None:
+        try:
+            logger.info("Generating locally: %s", request.prompt)
+            image_bytes = await run_blocking(generate_local, request)
+            return {
+                "success": True,
+                "image_bytes": image_bytes,
+                "media_type": "image/png",
+                "prompt": request.prompt,
+                "message": "Image generated successfully"
+            }
+        except Exception as e:
+            logger.warning("Local generation failed, falling back to API: %s", e)
+    
+    if not HF_API_KEYS:
+        return {"error": "No Hugging Face API key configured (set HF_API_KEYS)", "status_code": 503}
+    
+    logger.info("Generating: %s", request.prompt)
+    payload = {
+        "inputs": request.prompt,
+        "parameters": {
+            "width": request.width,
+            "height": request.height,
+            "num_inference_steps": request.num_inference_steps,
+            "guidance_scale": request.guidance_scale
+        }
+    }
+    
+    # Serialized once, not again for every key attempt
+    response, error, status_code = await hedged_post(json_bytes(payload))
+    if error is not None:
+        return {"error": error, "status_code": status_code}
+    
+    return {
+        "success": True,
+        "image_bytes": response.content,
+        "media_type": response.headers.get("content-type", "image/png"),
+        "prompt": request.prompt,
+        "message": "Image generated successfully"
+    }
+
+def get_text_to_image_status():
+    """Get text-to-image backend status"""
+    return {
+        "text_to_image": {
+            "backend": "local" if _FLUX_PIPE is not None else "huggingface_api",
+            "api_keys": len(HF_API_KEYS),
+            "cached_images": len(_image_cache)
+        }
+    }
@@ -0,0 +1,206 @@
+import io
+import json
+import os
+import queue
+import sys
+import atexit
+import logging
+import logging.handlers
+import asyncio
+import functools
+from binascii import b2a_base64
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from config import CPU_THREADS, MODEL_DIR  # noqa: F401 - re-exported for the services
+
+# BLAS/OpenMP runtimes read the thread budget once at load, so this module must be
+# imported before numpy/TensorFlow; explicit settings in the environment win.
+for _var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(_var, str(CPU_THREADS))
+
+try:
+    import h2  # noqa: F401 - only needed for HTTP/2 support in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Request-path logging goes through a queue; a listener thread does the stdout writes,
+# so a slow terminal or pipe never blocks the event loop
+_LOG_QUEUE = queue.SimpleQueue()
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, logging.StreamHandler(sys.stdout))
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
+
+def get_logger(name):
+    """Logger whose records are written by the background listener, as plain messages"""
+    logger = logging.getLogger(name)
+    if not logger.handlers:
+        logger.addHandler(logging.handlers.QueueHandler(_LOG_QUEUE))
+        logger.setLevel(logging.INFO)
+        # Already written by the listener; don't repeat through uvicorn's root handlers
+        logger.propagate = False
+    return logger
+
+# Shared pool for blocking CPU work (decode, inference, encode) so handlers don't
+# stall the event loop. OpenCV and ONNX Runtime release the GIL while they run.
+# Sized to this process's share of the cores, like the BLAS/OpenMP pools above.
+CV_POOL = ThreadPoolExecutor(max_workers=CPU_THREADS, thread_name_prefix="cv")
+
+# One pooled client for outbound API calls: keep-alive (and HTTP/2 when h2 is
+# installed) instead of a new TCP+TLS connection per request. Closed on shutdown.
+HTTP_CLIENT = httpx.AsyncClient(
+    http2=HTTP2_AVAILABLE,
+    timeout=60,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+)
+
+# Request coalescing defaults for MicroBatcher
+MAX_BATCH = 8
+MAX_WAIT = 0.01  # seconds to wait for more requests before running a batch
+
+# Uploads are read in chunks up to a cap, so an oversized file is never held whole
+MAX_UPLOAD_BYTES = 5 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+_UPLOAD_BUFFER_POOL = queue.LifoQueue(maxsize=8)
+
+# Encode buffers reused across requests instead of a fresh BytesIO each time
+_BUFFER_POOL = queue.LifoQueue(maxsize=32)
+
+async def run_blocking(func, *args, **kwargs):
+    """Run func(*args, **kwargs) on CV_POOL and await the result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(CV_POOL, functools.partial(func, *args, **kwargs))
+
+@contextmanager
+def pooled_bytesio():
+    """Borrow a BytesIO from the pool, rewound to the start
+
+    The buffer is not truncated (that would free its storage), so read the
+    result back with written_view() rather than getvalue().
+    """
+    try:
+        buf = _BUFFER_POOL.get_nowait()
+    except queue.Empty:
+        buf = io.BytesIO()
+    buf.seek(0)
+    try:
+        yield buf
+    finally:
+        try:
+            _BUFFER_POOL.put_nowait(buf)
+        except queue.Full:
+            pass
+
+def written_view(buf):
+    """Zero-copy view of what was written to a pooled_bytesio() buffer"""
+    return buf.getbuffer()[:buf.tell()]
+
+def to_data_uri(data, media_type):
+    """Base64 data URI for encoded image bytes, as returned in JSON responses"""
+    # Straight to the C encoder; accepts the pooled buffers' memoryviews as-is. The prefix
+    # is joined as bytes so the only str built is the final one.
+    prefix = f"data:{media_type};base64,".encode("ascii")
+    return (prefix + b2a_base64(data, newline=False)).decode("ascii")
+
+def json_bytes(obj):
+    """Serialize a request payload to JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+def acquire_upload_buffer():
+    """Take an upload buffer from the pool, allocating one if it is empty"""
+    try:
+        return _UPLOAD_BUFFER_POOL.get_nowait()
+    except queue.Empty:
+        # read_capped() checks each chunk before writing, so the limit itself is enough
+        return bytearray(MAX_UPLOAD_BYTES)
+
+def release_upload_buffer(buf):
+    """Return an upload buffer to the pool"""
+    try:
+        _UPLOAD_BUFFER_POOL.put_nowait(buf)
+    except queue.Full:
+        pass
+
+async def read_capped(file, max_bytes=MAX_UPLOAD_BYTES, buf=None):
+    """Read an upload in chunks, returning None as soon as it exceeds max_bytes
+
+    With buf (from acquire_upload_buffer) the data lands in that pooled buffer and
+    a memoryview of it is returned; otherwise a fresh bytearray is.
+    """
+    # Starlette knows the spooled size already, so obvious oversize needs no reads
+    if (getattr(file, "size", None) or 0) > max_bytes:
+        return None
+    data = bytearray() if buf is None else buf
+    size = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        if size + len(chunk) > max_bytes:
+            return None
+        data[size:size + len(chunk)] = chunk
+        size += len(chunk)
+    # Zero-copy view of the filled part; np.frombuffer can decode from it directly
+    return data if buf is None else memoryview(buf)[:size]
+
+class MicroBatcher:
+    """Gather concurrent predict() calls and hand them to _predict_batch together
+
+    Subclasses implement _predict_batch(items) -> list of results in the same
+    order; it runs on CV_POOL so the event loop keeps accepting requests.
+    """
+
+    def __init__(self, max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+        self._worker = None
+
+    async def predict(self, item):
+        """Return the result for item, batched with concurrent callers"""
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            items = [item for item, _ in batch]
+            try:
+                results = await loop.run_in_executor(CV_POOL, self._predict_batch, items)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def _predict_batch(self, items):
+        raise NotImplementedError